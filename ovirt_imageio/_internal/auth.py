@@ -7,6 +7,7 @@
 # (at your option) any later version.
 
 import logging
+import re
 import threading
 import urllib.parse as urllib_parse
 
@@ -18,30 +19,102 @@ from . import util
 
 log = logging.getLogger("auth")
 
+_NS_PER_SEC = 10**9
+
+
+# Ticket parameters: (attribute, key, type, required, default). If attribute
+# is None, the value is not stored in the ticket.
+_SCHEMA = (
+    ("_uuid", "uuid", str, True, None),
+    ("_size", "size", int, True, None),
+    ("_ops", "ops", list, True, None),
+    ("_timeout", "timeout", int, True, None),
+    # Default taken from the configuration.
+    ("_inactivity_timeout", "inactivity_timeout", int, False, None),
+    # Parsed and normalized after validation.
+    (None, "url", str, True, None),
+    ("_transfer_id", "transfer_id", str, False, None),
+    ("_filename", "filename", str, False, None),
+    ("_sparse", "sparse", bool, False, False),
+    ("_dirty", "dirty", bool, False, False),
+)
+
 
 class Ticket:
 
+    __slots__ = (
+        "_uuid",
+        "_size",
+        "_ops",
+        "_ops_set",
+        "_can_read",
+        "_can_write",
+        "_timeout",
+        "_inactivity_timeout",
+        "_timeout_ns",
+        "_expires_ns",
+        "_access_time_ns",
+        "_url",
+        "_url_str",
+        "_transfer_id",
+        "_filename",
+        "_sparse",
+        "_dirty",
+        "_info_static",
+        "_ops_lock",
+        "_conn_lock",
+        "_ongoing",
+        "_ongoing_count",
+        "_completed",
+        "_completed_sum",
+        "_canceled",
+        "_canceled_msg",
+        "_connections",
+        "_closing",
+    )
+
     def __init__(self, ticket_dict, cfg):
         if not isinstance(ticket_dict, dict):
             raise errors.InvalidTicket(
                 "Invalid ticket: %r, expecting a dict" % ticket_dict)
 
-        self._uuid = _required(ticket_dict, "uuid", str)
-        self._size = _required(ticket_dict, "size", int)
-        self._ops = _required(ticket_dict, "ops", list)
-
-        self._timeout = _required(ticket_dict, "timeout", int)
-        self._inactivity_timeout = _optional(
-            ticket_dict, "inactivity_timeout", int,
-            default=cfg.daemon.inactivity_timeout)
-
-        now = int(util.monotonic_time())
-        self._expires = now + self._timeout
-        self._access_time = now
-
-        url_str = _required(ticket_dict, "url", str)
+        for attr, key, expected_type, required, default in _SCHEMA:
+            try:
+                value = ticket_dict[key]
+            except KeyError:
+                if required:
+                    raise errors.MissingTicketParameter(key) from None
+                value = default
+            else:
+                if not isinstance(value, expected_type):
+                    raise errors.InvalidTicketParameter(
+                        key, value,
+                        "expecting a {!r} value".format(expected_type))
+            if attr is not None:
+                setattr(self, attr, value)
+
+        if self._inactivity_timeout is None:
+            self._inactivity_timeout = cfg.daemon.inactivity_timeout
+
+        # Precompute permissions checked on every request.
+        try:
+            self._ops_set = frozenset(self._ops)
+        except TypeError as e:
+            raise errors.InvalidTicketParameter("ops", self._ops, e)
+        # Having "write" imply also "read".
+        self._can_write = "write" in self._ops_set
+        self._can_read = self._can_write or "read" in self._ops_set
+
+        # Times are kept in nanoseconds to avoid conversions when touching
+        # the ticket. Values are reported as integer seconds.
+        self._timeout_ns = self._timeout * _NS_PER_SEC
+        now = util.monotonic_time_ns()
+        self._expires_ns = now + self._timeout_ns
+        self._access_time_ns = now
+
+        url_str = ticket_dict["url"]
         try:
-            self._url = urllib_parse.urlparse(url_str)
+            self._url = _parse_url(url_str)
         except (ValueError, AttributeError, TypeError) as e:
             raise errors.InvalidTicketParameter("url", url_str, e)
         if not backends.supports(self._url.scheme):
@@ -49,37 +122,71 @@ class Ticket:
                 "url", url_str,
                 "Unsupported url scheme: %s" % self._url.scheme)
 
-        self._transfer_id = _optional(ticket_dict, "transfer_id", str)
+        # The url never changes, so we can serialize it once.
+        self._url_str = urllib_parse.urlunparse(self._url)
 
         # Engine before 4.2.7 did not pass the transfer id. Generate a likey
         # unique value from the first half of the uuid.
         if self._transfer_id is None:
             self._transfer_id = f"(ticket/{self._uuid[:18]})"
 
-        self._filename = _optional(ticket_dict, "filename", str)
-        self._sparse = _optional(ticket_dict, "sparse", bool, default=False)
-        self._dirty = _optional(ticket_dict, "dirty", bool, default=False)
+        # Raised on every access after the ticket was canceled.
+        self._canceled_msg = f"Transfer {self._transfer_id} was canceled"
+
+        # Ticket info that never changes.
+        self._info_static = {
+            "inactivity_timeout": self._inactivity_timeout,
+            "size": self._size,
+            "sparse": self._sparse,
+            "dirty": self._dirty,
+            "timeout": self._timeout,
+            "url": self._url_str,
+            "uuid": self._uuid,
+        }
+        if self._transfer_id:
+            self._info_static["transfer_id"] = self._transfer_id
+        if self._filename:
+            self._info_static["filename"] = self._filename
+
+        # Protects _ongoing and _completed. Separate from _conn_lock so
+        # running operations do not contend with connections being added or
+        # removed. Also used for waiting until a ticket is unused during
+        # cancellation; a ticket can be removed only when there are no
+        # ongoing operations.
+        self._ops_lock = threading.Condition(threading.Lock())
 
-        self._operations = []
-        self._lock = threading.Lock()
+        # Protects _connections and _closing. Also used for waiting until
+        # another thread finished closing a connection context.
+        self._conn_lock = threading.Condition(threading.Lock())
 
         # Set holding ongoing operations.
         self._ongoing = set()
 
+        # Number of ongoing operations, updated from _ongoing under _ops_lock.
+        # Can be read without locking when only the number of operations is
+        # needed.
+        self._ongoing_count = 0
+
         # Ranges transferred by completed operations.
         self._completed = measure.RangeList()
 
+        # Cached sum of completed ranges, or None if completed ranges were
+        # modified since the last call to transferred().
+        self._completed_sum = 0
+
         # Set to true when a ticket is canceled. Once canceled, all operations
-        # on this ticket will raise errors.AuthorizationError.
+        # on this ticket will raise errors.AuthorizationError. Reading this
+        # flag does not require a lock, but code checking it before modifying
+        # the ticket state must check it again under the relevant lock.
         self._canceled = False
 
         # Mapping of connection id to connection context. When empty, this
         # ticket is not used by any connection.
         self._connections = {}
 
-        # Used for waiting until a ticket is unused during cancellation. A
-        # ticket can be removed only when this event is set.
-        self._unused = threading.Event()
+        # Connection ids of contexts being closed. Contexts are closed
+        # outside of the lock, but only by one thread at a time.
+        self._closing = set()
 
     @property
     def uuid(self):
@@ -99,7 +206,7 @@ class Ticket:
 
     @property
     def expires(self):
-        return self._expires
+        return self._expires_ns // _NS_PER_SEC
 
     @property
     def transfer_id(self):
@@ -131,7 +238,8 @@ class Ticket:
         """
         if self.active():
             return 0
-        return int(util.monotonic_time()) - self._access_time
+        idle_ns = util.monotonic_time_ns() - self._access_time_ns
+        return idle_ns // _NS_PER_SEC
 
     @property
     def inactivity_timeout(self):
@@ -143,35 +251,34 @@ class Ticket:
 
     @property
     def canceled(self):
-        with self._lock:
-            return self._canceled
+        return self._canceled
 
     def add_context(self, con_id, context):
-        with self._lock:
+        with self._conn_lock:
             if self._canceled:
-                raise errors.AuthorizationError(
-                    "Transfer {} was canceled".format(self.transfer_id))
+                raise errors.AuthorizationError(self._canceled_msg)
 
-            log.debug("Adding connection %s context to transfer %s",
-                      con_id, self.transfer_id)
             self._connections[con_id] = context
 
+        log.debug("Added connection %s context to transfer %s",
+                  con_id, self._transfer_id)
+
     def get_context(self, con_id):
         return self._connections[con_id]
 
     def remove_context(self, con_id):
-        with self._lock:
-            try:
-                context = self._connections[con_id]
-            except KeyError:
-                return
+        with self._conn_lock:
+            context = self._connections.get(con_id)
 
-            log.debug("Removing connection %s context from transfer %s",
-                      con_id, self.transfer_id)
-            context.close()
+        if context is None:
+            return
+
+        log.debug("Removing connection %s context from transfer %s",
+                  con_id, self._transfer_id)
 
-            # If context was closed, it is safe to remove it.
-            del self._connections[con_id]
+        # The context is kept until it is closed successfully, so the ticket
+        # cannot be removed while the context is open.
+        self._close_context(con_id, context, remove=True)
 
     def run(self, operation):
         """
@@ -191,43 +298,52 @@ class Ticket:
 
         Must be called when an operation is completed.
         """
-        now = int(util.monotonic_time())
-        self._expires = now + self._timeout
-        self._access_time = now
+        now = util.monotonic_time_ns()
+        self._expires_ns = now + self._timeout_ns
+        self._access_time_ns = now
 
     def _add_operation(self, op):
-        with self._lock:
+        with self._ops_lock:
             if self._canceled:
-                raise errors.AuthorizationError(
-                    "Transfer {} was canceled".format(self.transfer_id))
+                raise errors.AuthorizationError(self._canceled_msg)
 
             self._ongoing.add(op)
+            self._ongoing_count = len(self._ongoing)
 
     def _remove_operation(self, op):
-        with self._lock:
-            self._ongoing.remove(op)
+        # We don't report transfered bytes for read-write ticket. Create the
+        # range before taking the lock to keep the critical section short.
+        # If the ticket is canceled after checking, the range is not used.
+        if len(self._ops) == 1 and not self._canceled:
+            r = measure.Range(op.offset, op.offset + op.done)
+        else:
+            r = None
 
-            if self._canceled:
+        with self._ops_lock:
+            self._ongoing.discard(op)
+            self._ongoing_count = len(self._ongoing)
+
+            canceled = self._canceled
+            if canceled:
                 # If this was the last ongoing operation, wake up caller
                 # waiting on cancel().
-                if not self._ongoing:
-                    log.debug(
-                        "Removed last ongoring operation for transfer %s",
-                        self.transfer_id)
-                    self._unused.set()
-
-                raise errors.AuthorizationError(
-                    "Transfer {} was canceled".format(self.transfer_id))
-
-            # We don't report transfered bytes for read-write ticket.
-            if len(self.ops) == 1:
-                r = measure.Range(op.offset, op.offset + op.done)
+                last = self._ongoing_count == 0
+                if last:
+                    self._ops_lock.notify_all()
+            elif r is not None:
                 self._completed.add(r)
+                self._completed_sum = None
+
+        if canceled:
+            if last:
+                log.debug("Removed last ongoing operation for transfer %s",
+                          self._transfer_id)
+            raise errors.AuthorizationError(self._canceled_msg)
 
         self.touch()
 
     def active(self):
-        return bool(self._ongoing)
+        return self._ongoing_count > 0
 
     def transferred(self):
         """
@@ -237,50 +353,44 @@ class Ticket:
             # Both read and write, cannot report meaningful value.
             return None
 
-        with self._lock:
-            # NOTE: this must not modify the ticket state.
-            completed = measure.RangeList(self._completed)
-            ongoing = [measure.Range(op.offset, op.offset + op.done)
-                       for op in self._ongoing]
+        with self._ops_lock:
+            if self._ongoing_count == 0:
+                # Common case when polling inactive ticket.
+                if self._completed_sum is None:
+                    self._completed_sum = self._completed.sum()
+                return self._completed_sum
 
-        completed.update(ongoing)
-        return completed.sum()
+            # NOTE: this must not modify the ticket state. Completed ranges
+            # are modified in place, so they must be accessed under the lock.
+            ongoing = [(op.offset, op.offset + op.done)
+                       for op in self._ongoing]
+            ongoing.sort()
+            return self._completed.sum_with(ongoing)
 
     def may(self, op):
         if op == "read":
-            # Having "write" imply also "read".
-            return "read" in self.ops or "write" in self.ops
+            return self._can_read
+        elif op == "write":
+            return self._can_write
         else:
-            return op in self.ops
+            return op in self._ops_set
 
     def info(self):
-        info = {
-            "active": self.active(),
-            "canceled": self._canceled,
-            "connections": len(self._connections),
-            "expires": self._expires,
-            "idle_time": self.idle_time,
-            "inactivity_timeout": self._inactivity_timeout,
-            "ops": list(self._ops),
-            "size": self._size,
-            "sparse": self._sparse,
-            "dirty": self._dirty,
-            "timeout": self._timeout,
-            "url": urllib_parse.urlunparse(self._url),
-            "uuid": self._uuid,
-        }
-        if self._transfer_id:
-            info["transfer_id"] = self._transfer_id
-        if self.filename:
-            info["filename"] = self.filename
+        info = self._info_static.copy()
+        info["active"] = self.active()
+        info["canceled"] = self._canceled
+        info["connections"] = len(self._connections)
+        info["expires"] = self.expires
+        info["idle_time"] = self.idle_time
+        # Copy the ops since the caller may modify the returned info.
+        info["ops"] = list(self._ops)
         transferred = self.transferred()
         if transferred is not None:
             info["transferred"] = transferred
         return info
 
     def extend(self, timeout):
-        expires = int(util.monotonic_time()) + timeout
-        self._expires = expires
+        self._expires_ns = util.monotonic_time_ns() + timeout * _NS_PER_SEC
 
     def cancel(self, timeout=60):
         """
@@ -301,39 +411,42 @@ class Ticket:
         """
         log.debug("Cancelling transfer %s", self.transfer_id)
 
-        with self._lock:
+        with self._ops_lock:
             # No operation can start now, and new connections cannot be added
             # to the ticket.
             self._canceled = True
 
-            if not self._ongoing:
-                # There are no ongoing opearations, but we may have idle
-                # connections - release their resources.
-                for ctx in self._connections.values():
-                    ctx.close()
-                log.debug("Transfer %s was canceled", self.transfer_id)
-                return True
-
-            log.debug("Canceling transfer %s ongoing operations",
-                      self.transfer_id)
-            # Cancel ongoing operations. This speeds up cancellation when
-            # streaming lot of data. Operations will be canceled once they
-            # complete the current I/O.
-            for op in self._ongoing:
-                op.cancel()
+            # Cancelling operations and closing contexts is done outside of
+            # the lock, so finishing operations are not blocked.
+            ongoing = list(self._ongoing)
+
+        if not ongoing:
+            # There are no ongoing opearations, but we may have idle
+            # connections - release their resources.
+            self._close_connections()
+            log.debug("Transfer %s was canceled", self.transfer_id)
+            return True
+
+        log.debug("Canceling transfer %s ongoing operations",
+                  self.transfer_id)
+        # Cancel ongoing operations. This speeds up cancellation when
+        # streaming lot of data. Operations will be canceled once they
+        # complete the current I/O.
+        for op in ongoing:
+            op.cancel()
 
         if timeout:
             log.info("Waiting until transfer %s ongoing operations finish",
                      self.transfer_id)
-            if not self._unused.wait(timeout):
-                raise errors.TransferCancelTimeout(self.transfer_id)
+            with self._ops_lock:
+                if not self._ops_lock.wait_for(
+                        lambda: self._ongoing_count == 0, timeout):
+                    raise errors.TransferCancelTimeout(self.transfer_id)
 
             # Finished ongoing operations discover that the ticket was canceled
             # and close the connection. We need to release resources used by
             # idle connections.
-            with self._lock:
-                for ctx in self._connections.values():
-                    ctx.close()
+            self._close_connections()
 
             log.info("Transfer %s was canceled", self.transfer_id)
             return True
@@ -343,7 +456,49 @@ class Ticket:
         # caller must call again to delete the ticket.
         return False
 
-    def __repr__(self):
+    def _close_connections(self):
+        with self._conn_lock:
+            contexts = list(self._connections.items())
+
+        for con_id, ctx in contexts:
+            self._close_context(con_id, ctx)
+
+    def _close_context(self, con_id, context, remove=False):
+        """
+        Close context outside of the lock, since closing may block.
+
+        If another thread is closing the context, wait until it finishes,
+        so backend close() is never called concurrently. If the context was
+        removed meanwhile, there is nothing to do. If remove is True, remove
+        the context after closing it successfully.
+        """
+        with self._conn_lock:
+            self._conn_lock.wait_for(lambda: con_id not in self._closing)
+            if self._connections.get(con_id) is not context:
+                return
+            self._closing.add(con_id)
+
+        try:
+            context.close()
+        except BaseException:
+            with self._conn_lock:
+                self._closing.discard(con_id)
+                self._conn_lock.notify_all()
+            raise
+
+        with self._conn_lock:
+            self._closing.discard(con_id)
+            if remove and self._connections.get(con_id) is context:
+                del self._connections[con_id]
+            self._conn_lock.notify_all()
+
+    def details(self):
+        """
+        Return detailed description of the ticket.
+
+        This is much more expensive than repr(ticket), since it needs to
+        compute the number of transferred bytes.
+        """
         return ("<Ticket "
                 "active={active!r} "
                 "canceled={self._canceled} "
@@ -367,34 +522,63 @@ class Ticket:
                     connections=len(self._connections),
                     self=self,
                     transferred=self.transferred(),
-                    url=urllib_parse.urlunparse(self.url)
+                    url=self._url_str,
+                )
+
+    def __repr__(self):
+        return ("<Ticket "
+                "uuid={self._uuid!r} "
+                "transfer_id={self._transfer_id!r} "
+                "active={active!r} "
+                "canceled={self._canceled!r} "
+                "at {addr:#x}>"
+                ).format(
+                    active=self.active(),
+                    addr=id(self),
+                    self=self,
                 )
 
 
-def _required(d, key, type):
-    if key not in d:
-        raise errors.MissingTicketParameter(key)
-    return _validate(key, d[key], type)
+# Schemes that can be parsed by _parse_url() without urllib.
+_SIMPLE_SCHEMES = frozenset(["file", "nbd"])
 
+# Matches url without the scheme that can be parsed by _parse_url(): printable
+# ascii characters, except characters requiring parsing params, query, or
+# fragment, or validation of the netloc.
+_SIMPLE_URL_REST = re.compile(r"[^\x00-\x1f\x7f-\U0010ffff;?#\[\]]*\Z")
 
-def _optional(d, key, type, default=None):
-    if key not in d:
-        return default
-    return _validate(key, d[key], type)
 
+def _parse_url(url_str):
+    """
+    Parse url_str, returning urllib.parse.ParseResult.
+
+    Common file and nbd urls use only the scheme, netloc, and path, so we can
+    parse them without urllib.parse.urlparse(). Other urls are parsed by
+    urllib.parse.urlparse().
+    """
+    scheme, sep, rest = url_str.partition(":")
+    if (sep and
+            scheme in _SIMPLE_SCHEMES and
+            _SIMPLE_URL_REST.match(rest)):
+        if rest.startswith("//"):
+            netloc, slash, path = rest[2:].partition("/")
+            path = slash + path
+        else:
+            netloc, path = "", rest
+        return urllib_parse.ParseResult(scheme, netloc, path, "", "", "")
 
-def _validate(key, value, type):
-    if not isinstance(value, type):
-        raise errors.InvalidTicketParameter(
-            key, value, "expecting a {!r} value".format(type))
-    return value
+    return urllib_parse.urlparse(url_str)
 
 
 class Authorizer:
 
     def __init__(self, config):
         self._config = config
+        # Mapping of ticket uuid to Ticket. The mapping is never modified;
+        # writers replace it with a modified copy under _write_lock, so
+        # readers can access it without locking.
         self._tickets = {}
+        self._write_lock = threading.Lock()
 
     def add(self, ticket_dict):
         """
@@ -403,7 +587,10 @@ class Authorizer:
         Raises errors.InvalidTicket if ticket dict is invalid.
         """
         ticket = Ticket(ticket_dict, self._config)
-        self._tickets[ticket.uuid] = ticket
+        with self._write_lock:
+            tickets = dict(self._tickets)
+            tickets[ticket.uuid] = ticket
+            self._tickets = tickets
 
     def remove(self, ticket_id):
         try:
@@ -417,10 +604,17 @@ class Authorizer:
         # within the timeout.
         if ticket.cancel(self._config.control.remove_timeout):
             # Ticket is unused now, so it is safe to remove it.
-            del self._tickets[ticket_id]
+            with self._write_lock:
+                # The ticket may have been removed or replaced by another
+                # thread while we were waiting.
+                if self._tickets.get(ticket_id) is ticket:
+                    tickets = dict(self._tickets)
+                    del tickets[ticket_id]
+                    self._tickets = tickets
 
     def clear(self):
-        self._tickets.clear()
+        with self._write_lock:
+            self._tickets = {}
 
     def get(self, ticket_id):
         """
@@ -439,18 +633,28 @@ class Authorizer:
             raise errors.AuthorizationError(
                 "No such ticket {}".format(ticket_id))
 
-        log.debug("AUTH op=%s transfer=%s", op, ticket.transfer_id)
+        log.debug("AUTH op=%s transfer=%s", op, ticket._transfer_id)
 
-        if ticket.canceled:
+        # This runs on every request, so we access the ticket internals
+        # directly instead of using properties and Ticket.may().
+
+        if ticket._expires_ns <= util.monotonic_time_ns():
             raise errors.AuthorizationError(
-                "Transfer={} was canceled".format(ticket.transfer_id))
+                "Transfer={} expired".format(ticket._transfer_id))
 
-        if ticket.expires <= util.monotonic_time():
+        if ticket._canceled:
             raise errors.AuthorizationError(
-                "Transfer={} expired".format(ticket.transfer_id))
+                "Transfer={} was canceled".format(ticket._transfer_id))
+
+        if op == "read":
+            allowed = ticket._can_read
+        elif op == "write":
+            allowed = ticket._can_write
+        else:
+            allowed = op in ticket._ops_set
 
-        if not ticket.may(op):
+        if not allowed:
             raise errors.AuthorizationError(
-                "Transfer={} forbids {}".format(ticket.transfer_id, op))
+                "Transfer={} forbids {}".format(ticket._transfer_id, op))
 
         return ticket
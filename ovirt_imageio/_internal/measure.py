@@ -62,6 +62,37 @@ class RangeList:
     def sum(self):
         return sum(len(r) for r in self._ranges)
 
+    def sum_with(self, pairs):
+        """
+        Return the sum of this list merged with sorted list of (start, end)
+        pairs, without modifying this list or creating Range objects.
+        """
+        ranges = self._ranges
+        i = j = 0
+        total = 0
+        cur_start = cur_end = None
+
+        while i < len(ranges) or j < len(pairs):
+            if j == len(pairs) or (
+                    i < len(ranges) and ranges[i].start <= pairs[j][0]):
+                start, end = ranges[i].start, ranges[i].end
+                i += 1
+            else:
+                start, end = pairs[j]
+                j += 1
+
+            if cur_end is None or start > cur_end:
+                if cur_end is not None:
+                    total += cur_end - cur_start
+                cur_start, cur_end = start, end
+            elif end > cur_end:
+                cur_end = end
+
+        if cur_end is not None:
+            total += cur_end - cur_start
+
+        return total
+
 
 def _merged(ranges):
     """
@@ -11,6 +11,7 @@ import io
 import mmap
 import os
 import threading
+import time
 
 from .units import KiB
 
@@ -25,7 +26,21 @@ def start_thread(func, args=(), kwargs=None, name=None, daemon=True):
 
 
 def monotonic_time():
-    return os.times()[4]
+    """
+    Return monotonic time in seconds, using the same clock as
+    monotonic_time_ns().
+    """
+    return time.monotonic()
+
+
+# Integer nanoseconds, cheaper than monotonic_time() when comparing times on
+# hot paths.
+try:
+    monotonic_time_ns = time.monotonic_ns
+except AttributeError:
+    # Python < 3.7.
+    def monotonic_time_ns():
+        return int(time.monotonic() * 10**9)
 
 
 def humansize(n):
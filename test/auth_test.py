@@ -8,7 +8,9 @@
 
 import itertools
 import logging
+import threading
 import time
+import urllib.parse as urllib_parse
 
 import pytest
 
@@ -16,7 +18,7 @@ from ovirt_imageio._internal import config
 from ovirt_imageio._internal import errors
 from ovirt_imageio._internal import ops
 from ovirt_imageio._internal import util
-from ovirt_imageio._internal.auth import Ticket, Authorizer
+from ovirt_imageio._internal.auth import Ticket, Authorizer, _parse_url
 
 from test import testutil
 
@@ -34,6 +36,40 @@ class Context:
         self.closed = True
 
 
+class FailingContext:
+    """
+    Fails the first close() call.
+    """
+
+    def __init__(self):
+        self.count = 1
+        self.closed = False
+
+    def close(self):
+        if self.count > 0:
+            self.count -= 1
+            raise RuntimeError("Cannot close yet")
+        self.closed = True
+
+
+class BlockingContext:
+    """
+    Blocks in close() until released.
+    """
+
+    def __init__(self):
+        self.closing = threading.Event()
+        self.released = threading.Event()
+        self.closed = False
+        self.calls = 0
+
+    def close(self):
+        self.calls += 1
+        self.closing.set()
+        self.released.wait(10)
+        self.closed = True
+
+
 class Operation:
     """
     Used to fake a ops.Operation object.
@@ -391,6 +427,7 @@ def test_invalid_argument(arg, cfg):
     {"uuid": 1},
     {"size": "not an int"},
     {"ops": "not a list"},
+    {"ops": [["not", "hashable"]]},
     {"timeout": "not an int"},
     {"url": 1},
     {"transfer_id": 1},
@@ -404,6 +441,35 @@ def test_invalid_parameter(kw, cfg):
         Ticket(testutil.create_ticket(**kw), cfg)
 
 
+@pytest.mark.parametrize("key", ["uuid", "size", "ops", "timeout", "url"])
+def test_missing_parameter(key, cfg):
+    d = testutil.create_ticket()
+    del d[key]
+    with pytest.raises(errors.MissingTicketParameter):
+        Ticket(d, cfg)
+
+
+@pytest.mark.parametrize("url", [
+    "file:///path/to/file",
+    "file:/path/to/file",
+    "file:///path/to/file?query#fragment",
+    "file:///path/with%20space",
+    "nbd:unix:/path/to/socket:exportname=sda",
+    "nbd:localhost:10809:exportname=sda",
+    "nbd://localhost:10809/sda",
+    "nbd://localhost:10809//sda",
+    "nbd://[::1]:10809/sda",
+    "nbd://localhost:10809/sda;params",
+    "nbd+unix:///sda?socket=/path/to/socket",
+    "https://localhost:54322/images/ticket-id",
+    "FILE:///path/to/file",
+    "file:///path/to/f\u00efle",
+    "file:///path/to/\tfile",
+])
+def test_parse_url(url):
+    assert _parse_url(url) == urllib_parse.urlparse(url)
+
+
 def test_inactivity_timeout_unset(cfg):
     ticket = Ticket(testutil.create_ticket(inactivity_timeout=None), cfg)
     assert ticket.inactivity_timeout == cfg.daemon.inactivity_timeout
@@ -448,12 +514,26 @@ def test_repr(cfg):
         cfg)
     ticket_repr = repr(ticket)
 
+    info = ticket.info()
+
+    for key in ("uuid", "transfer_id", "active", "canceled"):
+        pair = "%s=%r" % (key, info[key])
+        assert pair in ticket_repr
+
+
+def test_details(cfg):
+    ticket = Ticket(
+        testutil.create_ticket(
+            ops=["read"], filename="tmp_file"),
+        cfg)
+    ticket_details = ticket.details()
+
     info = ticket.info()
     del info["timeout"]
 
     for key, value in info.items():
         pair = "%s=%r" % (key, value)
-        assert pair in ticket_repr
+        assert pair in ticket_details
 
 
 def test_ticket_run(cfg):
@@ -692,18 +772,6 @@ def test_remove_context_missing(cfg):
 
 def test_remove_context_error(cfg):
 
-    class FailingContext:
-
-        def __init__(self):
-            self.count = 1
-            self.closed = False
-
-        def close(self):
-            if self.count > 0:
-                self.count -= 1
-                raise RuntimeError("Cannot close yet")
-            self.closed = True
-
     ticket = Ticket(testutil.create_ticket(ops=["read"]), cfg)
     ctx = FailingContext()
     ticket.add_context(1, ctx)
@@ -722,6 +790,61 @@ def test_remove_context_error(cfg):
     assert ctx.closed
 
 
+def test_remove_context_close_error_keeps_context(cfg):
+    ticket = Ticket(testutil.create_ticket(ops=["read"]), cfg)
+    ctx = FailingContext()
+    ticket.add_context(1, ctx)
+
+    # If closing the context fails, the context is kept in the ticket.
+    with pytest.raises(RuntimeError):
+        ticket.remove_context(1)
+
+    assert not ctx.closed
+    assert ticket.get_context(1) is ctx
+    assert ticket.info()["connections"] == 1
+
+    # Canceling the ticket closes the context left by the failed removal.
+    ticket.cancel(timeout=0)
+    assert ctx.closed
+
+    # The context is still reported until the connection removes it.
+    assert ticket.info()["connections"] == 1
+    ticket.remove_context(1)
+    assert ticket.info()["connections"] == 0
+
+
+def test_remove_context_cancel_while_closing(cfg):
+    ticket = Ticket(testutil.create_ticket(ops=["read"]), cfg)
+    ctx = BlockingContext()
+    ticket.add_context(1, ctx)
+
+    remover = util.start_thread(ticket.remove_context, args=(1,))
+    try:
+        assert ctx.closing.wait(10)
+
+        # The context is kept while closing, so the ticket is still used.
+        assert ticket.info()["connections"] == 1
+
+        # Cancel waits until the context is closed, instead of closing it
+        # concurrently.
+        canceler = util.start_thread(ticket.cancel, kwargs={"timeout": 0})
+        try:
+            canceler.join(0.1)
+            assert canceler.is_alive()
+            assert ticket.info()["connections"] == 1
+        finally:
+            ctx.released.set()
+            canceler.join()
+    finally:
+        ctx.released.set()
+        remover.join()
+
+    # The context was closed once, and removed.
+    assert ctx.closed
+    assert ctx.calls == 1
+    assert ticket.info()["connections"] == 0
+
+
 def test_authorizer_add(cfg):
     auth = Authorizer(cfg)
     ticket_info = testutil.create_ticket(ops=["read"])
@@ -867,6 +990,41 @@ def test_authorizer_remove_async(cfg):
         auth.get(ticket.uuid)
 
 
+def test_authorizer_remove_replaced(cfg):
+    auth = Authorizer(cfg)
+    ticket_info = testutil.create_ticket(ops=["read"])
+    auth.add(ticket_info)
+    ticket = auth.get(ticket_info["uuid"])
+
+    # Ongoing operation blocks cancel.
+    op = Operation(0, 100)
+    ticket._add_operation(op)
+
+    cfg.control.remove_timeout = 10
+    remover = util.start_thread(auth.remove, args=(ticket.uuid,))
+    try:
+        # Wait until remove is waiting for the ongoing operation.
+        for i in range(100):
+            if ticket.canceled:
+                break
+            time.sleep(0.01)
+        assert ticket.canceled
+
+        # Replace the ticket while the old ticket is being canceled.
+        auth.add(ticket_info)
+        replacement = auth.get(ticket.uuid)
+        assert replacement is not ticket
+    finally:
+        # Finishing the operation completes the cancellation.
+        with pytest.raises(errors.AuthorizationError):
+            ticket._remove_operation(op)
+        remover.join()
+
+    # Removing the canceled ticket did not remove the replacement.
+    assert auth.get(ticket.uuid) is replacement
+    assert not replacement.canceled
+
+
 def test_authorizer_remove_mising(cfg):
     auth = Authorizer(cfg)
     # Removing missing ticket does not raise.
@@ -109,15 +109,20 @@ class FakeTime:
     def monotonic_time(self):
         return self.now
 
+    def monotonic_time_ns(self):
+        return int(self.now * 10**9)
+
 
 @pytest.fixture
 def fake_time(monkeypatch):
     """
-    Monkeypatch util.monotonic_time for testing time related operations.
+    Monkeypatch util.monotonic_time and util.monotonic_time_ns for testing
+    time related operations.
 
     Returns FakeTime instance. Modifying instance.now change the value returned
-    from the monkeypatched util.monotonic_time().
+    from the monkeypatched util.monotonic_time() and util.monotonic_time_ns().
     """
     time = FakeTime()
     monkeypatch.setattr(util, "monotonic_time", time.monotonic_time)
+    monkeypatch.setattr(util, "monotonic_time_ns", time.monotonic_time_ns)
     return time
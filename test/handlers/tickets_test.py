@@ -14,7 +14,6 @@ import pytest
 
 from ovirt_imageio._internal import config
 from ovirt_imageio._internal import server
-from ovirt_imageio._internal import util
 from ovirt_imageio._internal.handlers import tickets
 
 from .. import testutil
@@ -83,7 +82,7 @@ def test_put(srv, fake_time):
     with http.ControlClient(srv.config) as c:
         res = c.put("/tickets/%(uuid)s" % ticket, body)
         # Server adds expires key
-        ticket["expires"] = int(util.monotonic_time()) + ticket["timeout"]
+        ticket["expires"] = int(fake_time.now) + ticket["timeout"]
         ticket["active"] = False
         ticket["idle_time"] = 0
         ticket["canceled"] = False
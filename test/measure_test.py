@@ -239,6 +239,51 @@ def test_range_list_update_overlap_next_multi_all():
     assert rl.sum() == 70
 
 
+# Sum range list with pairs.
+
+
+def test_range_list_sum_with_empty():
+    rl = RangeList()
+    assert rl.sum_with([]) == 0
+
+
+def test_range_list_sum_with_no_pairs():
+    rl = RangeList()
+    rl.update([Range(0, 10), Range(20, 30)])
+    assert rl.sum_with([]) == 20
+
+
+def test_range_list_sum_with_only_pairs():
+    rl = RangeList()
+    assert rl.sum_with([(0, 10), (5, 15), (20, 30)]) == 25
+
+
+def test_range_list_sum_with_contiguous():
+    rl = RangeList()
+    rl.update([Range(0, 10), Range(100, 110)])
+    assert rl.sum_with([(10, 20), (110, 120)]) == 40
+
+
+def test_range_list_sum_with_overlap():
+    rl = RangeList()
+    rl.update([Range(0, 10), Range(20, 30), Range(40, 50), Range(60, 70)])
+    assert rl.sum_with([(5, 35), (25, 65)]) == 70
+
+
+def test_range_list_sum_with_contained():
+    rl = RangeList()
+    rl.update([Range(0, 100)])
+    assert rl.sum_with([(0, 0), (10, 20), (90, 100)]) == 100
+
+
+def test_range_list_sum_with_does_not_modify():
+    rl = RangeList()
+    rl.update([Range(0, 10), Range(20, 30)])
+    assert rl.sum_with([(10, 20)]) == 30
+    assert rl._ranges == [Range(0, 10), Range(20, 30)]
+    assert rl.sum() == 20
+
+
 # Copy range list.
 
 
@@ -58,6 +58,14 @@ def test_monotonic_time():
     assert t1 <= t2
 
 
+def test_monotonic_time_ns():
+    t1 = util.monotonic_time_ns()
+    time.sleep(0.01)
+    t2 = util.monotonic_time_ns()
+    assert isinstance(t1, int)
+    assert t1 < t2
+
+
 @pytest.mark.parametrize("size,rounded", [
     (0, 0),
     (1, 512),